@@ -3,15 +3,31 @@ CLAMS wrapper for NVIDIA NeMo Parakeet ASR models. Supports model selection (siz
 """
 
 import argparse
+import copy
+import functools
+import importlib.util
+import itertools
 import logging
-import tempfile
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+# use the parallel (Rust-based) downloader for model checkpoints when installed
+# this must be set before huggingface_hub is imported (by nemo)
+if importlib.util.find_spec('hf_transfer') is not None:
+    os.environ.setdefault('HF_HUB_ENABLE_HF_TRANSFER', '1')
 
 import ffmpeg
 import nemo.collections.asr as nemo_asr
+import numpy as np
+import torch
 from clams import ClamsApp, Restifier
+from huggingface_hub import snapshot_download, try_to_load_from_cache
 # For an NLP tool we need to import the LAPPS vocabulary items
 from lapps.discriminators import Uri
 from mmif import Mmif, AnnotationTypes, DocumentTypes
+from omegaconf import open_dict
 
 # Imports needed for Clams and MMIF.
 # Non-NLP Clams applications will require AnnotationTypes
@@ -28,122 +44,312 @@ PARAKEET_MODEL_VERSIONS = {
 }
 # as of writing (analyzer_ver) other models does not support punctuation and capitalization, so we do not support them
 
+# number of resampled audio streams to keep in memory, so that re-processing the same file skips ffmpeg
+# (note that an hour of 16kHz audio takes about 230MB as float32 array)
+# disabled by default, as files are usually processed only once; set PARAKEET_AUDIO_CACHE_SIZE to enable
+AUDIO_CACHE_SIZE = int(os.getenv('PARAKEET_AUDIO_CACHE_SIZE', '0'))
+# last applied local attention context size for each loaded model, so that
+# unchanged attention settings are not re-applied on every request
+_ATTN_STATE = weakref.WeakKeyDictionary()
+# same for the last applied decoding strategy
+_DECODING_STATE = weakref.WeakKeyDictionary()
+PRECISION_DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
 
 class ParakeetWrapper(ClamsApp):
 
     def __init__(self):
         super().__init__()
         self.model_cache = {}
+        self._model_lock = threading.Lock()
+        self._inference_lock = threading.Lock()
+        self._audio_cache = functools.lru_cache(maxsize=AUDIO_CACHE_SIZE)(self._resample)
 
     def _appmetadata(self):
         from metadata import appmetadata
         return appmetadata()
 
-    def _get_model(self, model_size):
+    @staticmethod
+    def _download_model(model_name):
+        # meno api does not support model versioning, and always downloads the `main` HEAD
+        # we need to pre-download model using HF api 
+        revision = PARAKEET_MODEL_VERSIONS[model_name]
+        # skip the download (and the HTTP requests to the hub) when the checkpoint of the revision is already on disk
+        checkpoint = f"{model_name.split('/')[-1]}.nemo"
+        if isinstance(try_to_load_from_cache(model_name, checkpoint, revision=revision), str):
+            return
+        # Download the model repository to the local cache
+        snapshot_download(repo_id=model_name, revision=revision, max_workers=8, etag_timeout=30)
+
+    def _get_model(self, model_size, device):
         model_name = PARAKEET_MODEL_SIZE_MAP[model_size]
-        if model_name not in self.model_cache:
-            if model_name not in PARAKEET_MODEL_VERSIONS:
-                raise ValueError(f"Unsupported model size {model_size}, note that this wrapper does not "
-                                 f"support all the Parakeet models. See parameters specification in the appmetadata.")
-            # meno api does not support model versioning, and always downloads the `main` HEAD
-            # we need to pre-download model using HF api 
-            from huggingface_hub import snapshot_download
-
-            # Download the model repository to the local cache
-            snapshot_download(repo_id=model_name, revision=PARAKEET_MODEL_VERSIONS[model_name])
-            self.model_cache[model_name] = nemo_asr.models.ASRModel.from_pretrained(model_name)
-        return self.model_cache[model_name]
+        # devices are counted within CUDA_VISIBLE_DEVICES, and we fall back to CPU when there's no visible GPU
+        if device == 'cuda' and not torch.cuda.is_available():
+            self.logger.warning("CUDA device is requested but not available, falling back to CPU")
+            device = 'cpu'
+        # the lock prevents loading the same model twice when the warm-up thread is still running
+        with self._model_lock:
+            if (model_name, device) not in self.model_cache:
+                if model_name not in PARAKEET_MODEL_VERSIONS:
+                    raise ValueError(f"Unsupported model size {model_size}, note that this wrapper does not "
+                                     f"support all the Parakeet models. See parameters specification in the appmetadata.")
+                self._download_model(model_name)
+                model = nemo_asr.models.ASRModel.from_pretrained(model_name, map_location=torch.device(device))
+                # inference only, no need to track gradients (freeze() also puts the model in eval mode)
+                model.freeze()
+                # set PARAKEET_TORCH_COMPILE=1 to compile the encoder (fused kernels + CUDA graphs)
+                if os.getenv('PARAKEET_TORCH_COMPILE', '0') == '1':
+                    self._compile_encoder(model)
+                self.model_cache[(model_name, device)] = model
+            return self.model_cache[(model_name, device)]
+
+    def _configure_decoding(self, model, strategy):
+        """
+        Sets the decoding strategy of the (TDT/RNN-T) decoder. For ``greedy_batch``, the CUDA graph decoder is enabled
+        as well, so that the batched decoding runs entirely on the GPU.
+        Hybrid TDT-CTC models transcribe with their TDT decoder by default, so the CTC decoder is left untouched.
+        """
+        if _DECODING_STATE.get(model) == strategy:
+            return
+        # edit a copy, the model's own config is only replaced when the new config is successfully applied,
+        # otherwise a broken config would stay on the model and be re-applied by every `transcribe()` call
+        decoding_cfg = copy.deepcopy(model.cfg.decoding)
+        try:
+            with open_dict(decoding_cfg):
+                decoding_cfg.strategy = strategy
+                if strategy == 'greedy_batch':
+                    decoding_cfg.greedy.use_cuda_graph_decoder = True
+            model.change_decoding_strategy(decoding_cfg)
+        except Exception as e:
+            # older NeMo versions don't have the CUDA graph decoder
+            self.logger.warning(f"Failed to switch to {strategy} decoding, using the current decoding: {e}")
+            return
+        _DECODING_STATE[model] = strategy
+
+    def _compile_encoder(self, model):
+        """
+        Compiles the Conformer encoder in place with ``torch.compile``. Input lengths vary between audio files, hence
+        dynamic shapes, and no CUDA graphs (that would be re-recorded for almost every input length, and are kept per
+        server thread). ``compile()`` is lazy, so the encoder is run on a second of silence to actually compile it,
+        and is reset to eager mode when that fails.
+        """
+        # later re-compilations (e.g., after attention changes) fall back to eager mode instead of failing the request
+        torch._dynamo.config.suppress_errors = True
+        try:
+            model.encoder.compile(mode='max-autotune-no-cudagraphs', dynamic=True)
+            with torch.inference_mode():
+                model.transcribe([np.zeros(16000, dtype=np.float32)], timestamps=False)
+        except Exception as e:
+            model.encoder._compiled_call_impl = None
+            self.logger.warning(f"Failed to compile the encoder, running it eagerly: {e}")
+
+    def warm_cache(self, load_default_model=True):
+        """
+        Downloads all supported model checkpoints to the local cache, so that the first request for each model size
+        does not need to wait for the download. When ``load_default_model`` is set, the default model is first loaded
+        and run on a second of silence to move the model loading and CUDA initialization off the first request.
+        """
+        if load_default_model:
+            defaults = {p.name: p.default for p in self.metadata.parameters}
+            default_size = defaults['modelSize']
+            model = self._get_model(default_size, defaults['device'])
+            with self._inference_lock, torch.inference_mode():
+                self._configure_decoding(model, defaults['decoderStrategy'])
+                model.transcribe([np.zeros(16000, dtype=np.float32)], timestamps=False)
+            self.logger.info(f"Warmed up {PARAKEET_MODEL_SIZE_MAP[default_size]}")
+        for model_name in PARAKEET_MODEL_VERSIONS:
+            try:
+                self._download_model(model_name)
+            except Exception as e:
+                self.logger.warning(f"Failed to pre-download {model_name}: {e}")
 
     @staticmethod
-    def convert_to_16k_wav_bytes(input_path):
+    def convert_to_16k_array(input_path):
         """
-        Converts an audio or video file to 16kHz mono WAV format using ffmpeg-python.
-        Returns the WAV data as bytes (in-memory, no output file).
+        Converts an audio or video file to 16kHz mono audio using ffmpeg-python.
+        Returns the audio samples as a float32 numpy array (in-memory, no output file).
+        """
+        try:
+            out, _ = (ffmpeg.input(input_path)
+                      .output('pipe:', format='s16le', acodec='pcm_s16le', ac=1, ar=16000)
+                      .run(capture_stdout=True, quiet=True))
+        except ffmpeg.Error as e:
+            # ffmpeg's stderr is captured (not shown), so include it in the error
+            raise ValueError(f"Failed to read audio from {input_path}: {e.stderr.decode(errors='replace')}") from e
+        return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+    @staticmethod
+    def _resample(input_path, mtime_ns, size):
+        # mtime and size are not used for resampling, but are part of the cache key
+        # so that a modified file at the same location is not served from the cache
+        audio = ParakeetWrapper.convert_to_16k_array(input_path)
+        audio.flags.writeable = False  # cached arrays are shared between requests
+        return audio
+
+    def load_16k_audio(self, input_path):
         """
-        temp_wav = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        temp_wav.close()  # Close the file so ffmpeg can write to it
-        ffmpeg.input(input_path).output(temp_wav.name, format='wav', ac=1, ar=16000).overwrite_output().run()
-        return temp_wav.name  # Return the path to the temporary WAV file
-    
+        Returns the 16kHz mono audio of the file as a float32 numpy array,
+        re-using previously resampled audio when the file has not changed since.
+        """
+        input_path = os.path.abspath(input_path)
+        stat = os.stat(input_path)
+        return self._audio_cache(input_path, stat.st_mtime_ns, stat.st_size)
+
+    def _autocast(self, model, precision):
+        """
+        Returns an autocast context to run the model in the requested precision.
+        Model weights are kept in fp32, so the same cached model can serve any precision.
+        Reduced precision is only used on CUDA devices, and bf16 falls back to fp32 on GPUs without native bf16 support
+        (compute capability below 8.0, e.g., T4 or V100).
+        """
+        dtype = PRECISION_DTYPES[precision]
+        device_type = model.device.type
+        if device_type != 'cuda':
+            dtype = torch.float32
+        # `torch.cuda.is_bf16_supported()` also counts emulated bf16 (on pre-Ampere GPUs) as supported
+        elif dtype is torch.bfloat16 and torch.cuda.get_device_capability(model.device)[0] < 8:
+            self.logger.warning("bf16 is not supported on this GPU, falling back to fp32")
+            dtype = torch.float32
+        return torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype is not torch.float32)
+
+    @staticmethod
+    def _offload_hypothesis(hypothesis):
+        for k, v in vars(hypothesis).items():
+            if torch.is_tensor(v):
+                setattr(hypothesis, k, v.detach().cpu())
+
     def _annotate(self, mmif: Mmif, **parameters) -> Mmif:
         model_size = parameters['modelSize']
-        model = self._get_model(model_size)
+        model = self._get_model(model_size, parameters['device'])
         # Find audio/video documents
-        for srcdoc in mmif.get_documents_by_type(DocumentTypes.AudioDocument) \
-                   + mmif.get_documents_by_type(DocumentTypes.VideoDocument):
-            audio_path = srcdoc.location_path()
-            resampled = self.convert_to_16k_wav_bytes(audio_path)
-            
+        # (single pass over the top-level documents and the documents in views, as in `Mmif.get_documents_by_type`,
+        # each document is picked at most once)
+        srcdocs = [doc for doc in itertools.chain(mmif.documents, *(view.get_documents() for view in mmif.views))
+                   if doc.at_type in (DocumentTypes.AudioDocument, DocumentTypes.VideoDocument)]
+        if not srcdocs:
+            return mmif
+        # ffmpeg runs in subprocesses, so resampling multiple documents can run concurrently in threads
+        with ThreadPoolExecutor(max_workers=min(os.cpu_count() or 1, len(srcdocs))) as executor:
+            resampled = list(executor.map(self.load_16k_audio, [srcdoc.location_path() for srcdoc in srcdocs]))
+
+        # the model (and its settings) is shared between concurrent requests (server threads),
+        # so configuring and running it must not interleave
+        with self._inference_lock:
             # disable global attention to reduce memory usage
-            model.change_attention_model("rel_pos_local_attn", [parameters['contextSize'], parameters['contextSize']])
-            model.change_subsampling_conv_chunking_factor(1)  # 1 = auto select
-
-            # Run ASR with word-level timestamping
-            result = model.transcribe([resampled], timestamps=True)
-            # result is a list of `Hypothesis` objects (maybe one for each audio file?)
-            result = result[0]  # Assuming single audio file input, take the first result
-            # not result has (among others) `text` (str), `words` (list of str) and `timestamp` (dict) attributes
+            # reconfiguring attention rebuilds encoder modules,
+            # so skip it when the model is already set to the context size
+            context_size = parameters['contextSize']
+            if _ATTN_STATE.get(model) != context_size:
+                model.change_attention_model("rel_pos_local_attn", [context_size, context_size])
+                model.change_subsampling_conv_chunking_factor(1)  # 1 = auto select
+                _ATTN_STATE[model] = context_size
+            self._configure_decoding(model, parameters['decoderStrategy'])
+
+            # Run ASR with word-level timestamping, all documents in a single (batched) call
+            # inputs are sorted by duration, so that each batch holds audio of similar length and wastes less on padding
+            order = sorted(range(len(resampled)), key=lambda i: resampled[i].shape[0])
+            with torch.inference_mode(), self._autocast(model, parameters['precision']):
+                sorted_results = model.transcribe([resampled[i] for i in order], timestamps=True,
+                                                  batch_size=parameters['batchSize'])
+        # results is a list of `Hypothesis` objects, one for each audio file, restored to the document order
+        results = [None] * len(resampled)
+        for i, result in zip(order, sorted_results):
+            results[i] = result
+        # hypotheses can hold on to GPU tensors (e.g., alignments), move them off the GPU before building views
+        for result in results:
+            self._offload_hypothesis(result)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        for srcdoc, result in zip(srcdocs, results):
+            # now result has (among others) `text` (str), `words` (list of str) and `timestamp` (dict) attributes
             # and the `timestamp` dict has keys 'timestep', 'word', 'segment', and 'char' with lists of timestamps
             # and values are list of dicts with 'start', 'end', and the corresponding segmentation type (e.g., 'word', 'segment', 'char')
             # time notations are in seconds.
+            self._annotate_hypothesis(mmif, srcdoc, result, parameters)
+        return mmif
+
+    def _annotate_hypothesis(self, mmif: Mmif, srcdoc, result, parameters):
+        # create a new view per audio/video input document
+        view = mmif.new_view()
+        self.sign_view(view, parameters)
 
-            # create a new view per audio/video input document
-            view = mmif.new_view()
-            self.sign_view(view, parameters)
-
-            # convert result.text to a TextDocument annotation
-            raw_text = result.text.strip()
-            td_ann = view.new_textdocument(raw_text, lang='en')
-            view.new_annotation(AnnotationTypes.Alignment, source=srcdoc.long_id, target=td_ann.long_id)
-            char_offset = 0
-            segment_token_ids = []
-            segment_idx = 0
-            segments_offset = 0
-            for word_dict in result.timestamp["word"]:
-                
-                raw_token = word_dict["word"]
-                # find this token’s position in the entire text
+        # convert result.text to a TextDocument annotation
+        raw_text = result.text.strip()
+        raw_text_len = len(raw_text)
+        td_ann = view.new_textdocument(raw_text, lang='en')
+        td_id = td_ann.long_id
+        view.new_annotation(AnnotationTypes.Alignment, source=srcdoc.long_id, target=td_id)
+        # mmif-python has no bulk API to add annotations, so keep the per-word calls as cheap as possible
+        new_annotation = view.new_annotation
+        char_offset = 0
+        segment_token_ids = []
+        segment_idx = 0
+        seg_texts = [segment['segment'].strip() for segment in result.timestamp["segment"]]
+        seg_ends = [segment['end'] for segment in result.timestamp["segment"]]
+        num_segments = len(seg_texts)
+        # convert word times from seconds to milliseconds all at once
+        # (float64 to truncate exactly like int(), and back to python ints for JSON serialization)
+        words = result.timestamp["word"]
+        tf_starts = (np.fromiter((w["start"] for w in words), np.float64, len(words)) * 1000).astype(np.int64).tolist()
+        tf_ends = (np.fromiter((w["end"] for w in words), np.float64, len(words)) * 1000).astype(np.int64).tolist()
+        for i, word_dict in enumerate(words):
+
+            raw_token = word_dict["word"]
+            # find this token’s position in the entire text
+            # tokens appear in order, separated by whitespace, so skipping the whitespace is usually enough
+            tok_start = char_offset
+            while tok_start < raw_text_len and raw_text[tok_start].isspace():
+                tok_start += 1
+            tok_end = tok_start + len(raw_token)
+            if raw_text[tok_start:tok_end] != raw_token:
+                # fall back to searching when the token isn't where we expect it to be
                 tok_start = raw_text.index(raw_token, char_offset)
                 tok_end = tok_start + len(raw_token)
-                char_offset = tok_end
-
-                token = view.new_annotation(
-                    Uri.TOKEN,
-                    word=raw_token,
-                    start=tok_start,
-                    end=tok_end,
-                    document=f'{td_ann.long_id}'
-                )
-                segment_token_ids.append(token.long_id)
-
-                tf_start = int(word_dict["start"] * 1000)
-                tf_end = int(word_dict["end"] * 1000)
-                tf = view.new_annotation(
-                    AnnotationTypes.TimeFrame,
-                    label="speech",
-                    start=tf_start,
-                    end=tf_end
-                )
-                view.new_annotation(
-                    AnnotationTypes.Alignment,
-                    source=tf.long_id,
-                    target=token.long_id
+            char_offset = tok_end
+
+            token = new_annotation(
+                Uri.TOKEN,
+                word=raw_token,
+                start=tok_start,
+                end=tok_end,
+                document=td_id
+            )
+            token_id = token.long_id
+            segment_token_ids.append(token_id)
+
+            tf = new_annotation(
+                AnnotationTypes.TimeFrame,
+                label="speech",
+                start=tf_starts[i],
+                end=tf_ends[i]
+            )
+            new_annotation(
+                AnnotationTypes.Alignment,
+                source=tf.long_id,
+                target=token_id
+            )
+            # simultaneously track the segment index while looping through words
+            # segment timestamps are derived from the word timestamps, so the last word of a segment
+            # ends exactly when the segment ends, regardless of the whitespace between segments in the text
+            if segment_idx < num_segments and word_dict["end"] >= seg_ends[segment_idx]:
+                new_annotation(
+                    Uri.SENTENCE,
+                    targets=segment_token_ids,
+                    text=seg_texts[segment_idx],
                 )
-                # simultaneously track the segment index while looping through words
-                # note that char_offset is tracking offset from the very beginning of the text
-                # while segments_offset is tracking offset from the beginning of the current segment
-                cur_segment_text = result.timestamp["segment"][segment_idx]['segment'].strip()
-                # when we have reached the end of the current segment, see next segment
-                if char_offset - segments_offset > len(cur_segment_text):
-                    view.new_annotation(
-                        Uri.SENTENCE,
-                        targets=segment_token_ids,
-                        text=cur_segment_text,
-                    )
-                    segment_idx += 1
-                    segments_offset += len(cur_segment_text) + 1  # +1 for the space after each segment 
-                    segment_token_ids = []  # reset for the next segment
-        return mmif
+                segment_idx += 1
+                segment_token_ids = []  # reset for the next segment
+        # in case the last segment didn't end with a word
+        if segment_token_ids and segment_idx < num_segments:
+            new_annotation(
+                Uri.SENTENCE,
+                targets=segment_token_ids,
+                text=seg_texts[segment_idx],
+            )
 
 def get_app():
     return ParakeetWrapper()
@@ -152,6 +358,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", action="store", default="5000", help="set port to listen")
     parser.add_argument("--production", action="store_true", help="run gunicorn server")
+    parser.add_argument("--threads", action="store", default="8",
+                        help="number of threads to serve requests in the production server. A single worker process "
+                             "is used, so that all threads share one copy of the model weights in (GPU) memory")
     # add more arguments as needed
     # parser.add_argument(more_arg...)
 
@@ -161,13 +370,24 @@ if __name__ == "__main__":
     # if get_app() call requires any "configurations", they should be set now as global variables
     # and referenced in the get_app() function. NOTE THAT you should not change the signature of get_app()
     app = get_app()
+    # set PARAKEET_WARMUP=0 to skip pre-downloading models at startup
+    warmup = os.getenv('PARAKEET_WARMUP', '1') == '1'
 
     http_app = Restifier(app, port=int(parsed_args.port))
     # for running the application in production mode
     if parsed_args.production:
-        http_app.serve_production()
+        # gunicorn forks the worker process after this point, and neither CUDA nor running threads survive a fork,
+        # hence the warm-up is started in the worker process, once it's ready to serve
+        options = {}
+        if warmup:
+            options['post_worker_init'] = lambda worker: threading.Thread(target=app.warm_cache, daemon=True).start()
+        http_app.serve_production(workers=1, threads=int(parsed_args.threads), **options)
     # development mode
     else:
         app.logger.setLevel(logging.DEBUG)
+        # with the (debug mode) reloader, this block runs in both the watcher and the serving process,
+        # and only the serving process (where WERKZEUG_RUN_MAIN is set) should load the model
+        if warmup and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            threading.Thread(target=app.warm_cache, daemon=True).start()
         http_app.run()
 
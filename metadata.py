@@ -63,6 +63,43 @@ def appmetadata() -> AppMetadata:
         choices=['110m', '0.6b', '1.1b'],
         default='0.6b'
     )
+    metadata.add_parameter(
+        name='batchSize',
+        description='Number of audio streams to transcribe together in a single batch when the input MMIF contains '
+                    'multiple audio/video documents. Larger batch sizes utilize the GPU better, but require more '
+                    'memory. Default is 8',
+        type='integer',
+        default='8'
+    )
+    metadata.add_parameter(
+        name='precision',
+        description='Numerical precision to run the model in. `bf16` and `fp16` use mixed precision (automatic casting) '
+                    'and roughly halve the memory traffic of the model, which speeds up transcription on recent GPUs. '
+                    'Reduced precisions are only used on CUDA devices, and `bf16` falls back to `fp32` on GPUs '
+                    'without native bf16 support (compute capability below 8.0, e.g., T4 or V100). '
+                    'Choices: fp32, bf16, fp16',
+        type='string',
+        choices=['fp32', 'bf16', 'fp16'],
+        default='bf16'
+    )
+    metadata.add_parameter(
+        name='device',
+        description='Device to run the model on. `cuda` uses the first GPU visible to the app (see the '
+                    '`CUDA_VISIBLE_DEVICES` environment variable), and falls back to `cpu` when no GPU is available. '
+                    'Choices: cuda, cpu',
+        type='string',
+        choices=['cuda', 'cpu'],
+        default='cuda'
+    )
+    metadata.add_parameter(
+        name='decoderStrategy',
+        description='Decoding strategy of the model. `greedy_batch` decodes the whole batch at once on the GPU, and '
+                    'is usually faster than `greedy` that decodes one audio stream at a time. Choices: greedy, '
+                    'greedy_batch',
+        type='string',
+        choices=['greedy', 'greedy_batch'],
+        default='greedy_batch'
+    )
     return metadata
 
 